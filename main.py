@@ -1,25 +1,156 @@
 
 import os
 import argparse
+import json
+import sqlite3
+import threading
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from queue import Queue
+
+# Keep OpenMP/BLAS single-threaded unless the user says otherwise; images are
+# processed in parallel by the worker pool instead. These are only read when
+# the libraries load, so they must be set before importing cv2 and numpy.
+for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(name, "1")
+
 import dlib
-from PIL import Image
 import cv2
-from pathlib import Path
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# libjpeg-turbo decodes JPEGs faster than the decoder bundled with some
+# OpenCV wheels; used when PyTurboJPEG and the shared library are present.
+try:
+    from turbojpeg import TurboJPEG
+    jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    jpeg = None
+
+# Print a line for every image, not just the summary (--verbose)
+verbose = False
 
 # Load face detection model
 detector = dlib.get_frontal_face_detector()
 
-def resize_and_center_face(image_path, size):
-    image = cv2.imread(image_path)
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    faces = detector(image_rgb)
+# Image file extensions picked up when resizing a directory
+SUPPORTED_FORMATS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tiff', '.tif')
+JPEG_FORMATS = ('.jpg', '.jpeg')
+
+# Longest side, in pixels, of the image the CPU face detector runs on
+DETECTION_MAX_SIZE = 640
+
+# Preallocated output images, keyed by size
+_output_buffers = {}
+
+# Face boxes and written outputs from earlier runs, kept next to the output images
+CACHE_NAME = ".facecrop_cache.db"
+
+# Decoded images the reader thread may hold ahead of processing
+PREFETCH_SIZE = 8
+
+# Number of images sent to the GPU detector in a single call
+GPU_BATCH_SIZE = 32
+
+# Longest side, in pixels, of the images the GPU detector runs on
+GPU_MAX_SIZE = 1080
+
+# Minimum RetinaFace confidence for a box to count as a face
+GPU_THRESHOLD = 0.9
+
+# Optional batched GPU detector, enabled with FACECROP_DEVICE=cuda and loaded
+# on first use. dlib stays in use as the CPU fallback.
+gpu_detector = None
+
+def load_gpu_detector():
+    global gpu_detector
+    try:
+        from batch_face import RetinaFace
+        gpu_detector = RetinaFace(gpu_id=0, fp16=True)
+    except Exception as e:
+        print(f"Warning: GPU face detector unavailable ({e}), falling back to dlib.")
+
+# dlib's CNN (MMOD) detector, used on the GPU with --detector cnn
+cnn_detector = None
+
+def load_cnn_detector(model_path):
+    global cnn_detector
+    if not dlib.DLIB_USE_CUDA:
+        print("Warning: dlib was built without CUDA, falling back to the HOG detector.")
+        return
+    try:
+        cnn_detector = dlib.cnn_face_detection_model_v1(model_path)
+    except RuntimeError as e:
+        print(f"Warning: CNN face detector unavailable ({e}), falling back to the HOG detector.")
+
+def log(message):
+    if verbose:
+        print(message)
+
+def detect_faces(image):
+    # HOG only looks at intensity gradients, so grayscale is enough
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Detection cost grows with pixel count, so run it on a downscaled copy
+    # and map the boxes back to full resolution.
+    scale = DETECTION_MAX_SIZE / max(image.shape[:2])
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        scale = 1
+    faces = detector(gray, 0)
+    return [
+        (int(face.left() / scale), int(face.top() / scale), int(face.right() / scale), int(face.bottom() / scale))
+        for face in faces
+    ]
+
+def detect_faces_batch(images):
+    # pseudo_batch_detect groups images of equal size, so inputs of mixed
+    # resolution still go through the detector in as few calls as possible.
+    # Large inputs are shrunk to max_size for detection, and boxes come back
+    # in the coordinates of the original images.
+    all_faces = gpu_detector.pseudo_batch_detect(images, cv=True, threshold=GPU_THRESHOLD, max_size=GPU_MAX_SIZE)
+    return [[tuple(int(v) for v in face[0]) for face in faces] for faces in all_faces]
+
+def detect_faces_cnn_batch(images):
+    # dlib only batches images of equal size, so each one is shrunk to fit
+    # the detection size and padded into a square canvas.
+    canvases = []
+    scales = []
+    for image in images:
+        shrink = min(DETECTION_MAX_SIZE / max(image.shape[:2]), 1)
+        small = cv2.resize(image, None, fx=shrink, fy=shrink, interpolation=cv2.INTER_AREA)
+        canvas = np.zeros((DETECTION_MAX_SIZE, DETECTION_MAX_SIZE, 3), np.uint8)
+        canvas[:small.shape[0], :small.shape[1]] = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        canvases.append(canvas)
+        scales.append(small.shape[1] / image.shape[1])
+    all_faces = cnn_detector(canvases, 0, batch_size=len(canvases))
+    return [
+        [(int(face.rect.left() / scale), int(face.rect.top() / scale),
+          int(face.rect.right() / scale), int(face.rect.bottom() / scale)) for face in faces]
+        for faces, scale in zip(all_faces, scales)
+    ]
+
+def _output_buffer(size):
+    # Reused between images so every crop writes into the same memory
+    if size not in _output_buffers:
+        _output_buffers[size] = np.empty((size, size, 3), np.uint8)
+    return _output_buffers[size]
+
+def center_face(image, faces, size, image_path):
+    # The returned array is the shared output buffer for this size, so it is
+    # only valid until the next call; callers that keep it must copy it.
     if len(faces) > 0:
-        print(f"Found {len(faces)} faces in {image_path}")
-        face = faces[0]
-        center_x = (face.left() + face.right()) // 2
-        center_y = (face.top() + face.bottom()) // 2
+        log(f"Found {len(faces)} faces in {image_path}")
+        left, top, right, bottom = faces[0]
+        center_x = (left + right) // 2
+        center_y = (top + bottom) // 2
     else:
-        print("Warning: No faces found.")
+        log(f"Warning: No faces found in {image_path}.")
         center_x = image.shape[1] // 2
         center_y = image.shape[0] // 2
 
@@ -28,42 +159,296 @@ def resize_and_center_face(image_path, size):
     right = min(center_x + size // 2, image.shape[1])
     bottom = min(center_y + size // 2, image.shape[0])
 
-    cropped_image = image[top:bottom, left:right]
-    resized_image = cv2.resize(cropped_image, (size, size))
-    pil_image = Image.fromarray(cv2.cvtColor(resized_image, cv2.COLOR_BGR2RGB))
-    return pil_image
+    # Resize the crop straight into the output buffer in one pass over the
+    # pixels. Slicing only creates a view, and the affine transform uses the
+    # same pixel-centre convention and edge clamping as cv2.resize.
+    scale_x = size / (right - left)
+    scale_y = size / (bottom - top)
+    matrix = np.array([
+        [scale_x, 0, 0.5 * scale_x - 0.5],
+        [0, scale_y, 0.5 * scale_y - 0.5],
+    ])
+    output = _output_buffer(size)
+    cv2.warpAffine(image[top:bottom, left:right], matrix, (size, size), dst=output, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return output
+
+def is_valid_image(path):
+    return path.lower().endswith(SUPPORTED_FORMATS)
+
+def exif_orientation(data):
+    # Orientation tag (0x0112) from a JPEG's EXIF block, or 1 if it has none
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b"Exif\0\0":
+            tiff = data[pos + 10:pos + 2 + length]
+            order = "little" if tiff[:2] == b"II" else "big"
+            ifd = int.from_bytes(tiff[4:8], order)
+            for i in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+                entry = ifd + 2 + 12 * i
+                if int.from_bytes(tiff[entry:entry + 2], order) == 0x0112:
+                    return int.from_bytes(tiff[entry + 8:entry + 10], order)
+            return 1
+        if marker == 0xDA:
+            break
+        pos += 2 + length
+    return 1
+
+def read_image(image_path):
+    if jpeg is not None and image_path.lower().endswith(JPEG_FORMATS):
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        # libjpeg-turbo ignores EXIF orientation while cv2.imread applies it;
+        # leave rotated photos to OpenCV so the output does not depend on
+        # which decoder is installed.
+        if exif_orientation(data) != 1:
+            return cv2.imread(image_path)
+        return jpeg.decode(data)
+    return cv2.imread(image_path)
+
+def resize_and_center_face(image_path, size):
+    image = read_image(image_path)
+    return center_face(image, detect_faces(image), size, image_path).copy()
+
+def _read_images(image_paths, queue):
+    try:
+        for image_path in image_paths:
+            queue.put((image_path, read_image(image_path)))
+    except Exception as e:
+        # Hand the error to the consumer, which re-raises it
+        queue.put(e)
+        return
+    queue.put(None)
+
+def prefetch_images(image_paths):
+    # Decode images on a background thread so disk reads overlap with face
+    # detection; both decoders release the GIL while they work.
+    queue = Queue(maxsize=PREFETCH_SIZE)
+    threading.Thread(target=_read_images, args=(image_paths, queue), daemon=True).start()
+    while (item := queue.get()) is not None:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def output_path_for(image_path, output_folder):
+    name, extension = os.path.splitext(os.path.basename(image_path))
+    output_name = name + ".out" + extension
+    return os.path.join(output_folder, output_name)
+
+def save_image(resized_image, image_path, output_folder):
+    output_path = output_path_for(image_path, output_folder)
+    params = [cv2.IMWRITE_JPEG_QUALITY, 92] if output_path.lower().endswith(JPEG_FORMATS) else []
+    if not cv2.imwrite(output_path, resized_image, params):
+        raise OSError(f"Could not write {output_path}")
+    log(f"Image saved to {output_path}")
+
+def _init_worker(verbose_output):
+    # Build the detector inside each worker rather than relying on the copy
+    # inherited from (or re-imported by) the parent process.
+    global detector, verbose
+    detector = dlib.get_frontal_face_detector()
+    verbose = verbose_output
+    # Parallelism comes from the pool itself; letting OpenCV spawn a thread
+    # per core in every worker oversubscribes the CPU.
+    cv2.setNumThreads(1)
+
+def default_workers():
+    # HOG detection gains little from SMT siblings, so prefer physical cores,
+    # and respect the CPU affinity / cgroup limits on Linux.
+    physical = psutil.cpu_count(logical=False) if psutil else None
+    if hasattr(os, "sched_getaffinity"):
+        available = len(os.sched_getaffinity(0))
+    else:
+        available = cpu_count()
+    return min(physical or available, available)
+
+def open_detection_cache(output_folder):
+    cache = sqlite3.connect(os.path.join(output_folder, CACHE_NAME))
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS faces "
+        "(path TEXT, detector TEXT, mtime REAL, boxes TEXT, PRIMARY KEY (path, detector))"
+    )
+    cache.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+    return cache
+
+def finished_images(cache, image_paths, output_folder, size):
+    # An output only counts as done if it was written at the requested size
+    # from the current version of the input; file names do not encode the
+    # size, and an edited input needs a new crop.
+    finished = set()
+    for image_path in image_paths:
+        output_path = output_path_for(image_path, output_folder)
+        row = cache.execute(
+            "SELECT size, mtime FROM outputs WHERE path = ?", (os.path.abspath(output_path),)
+        ).fetchone()
+        if (row is not None and row[0] == size and row[1] == os.path.getmtime(image_path)
+                and os.path.exists(output_path)):
+            finished.add(image_path)
+    return finished
+
+def store_outputs(cache, written, output_folder, size):
+    with cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)",
+            [(os.path.abspath(output_path_for(image_path, output_folder)), size, os.path.getmtime(image_path))
+             for image_path in written],
+        )
+
+def cached_faces(cache, image_paths, detector_name):
+    # Detection is deterministic, so files that have not changed since the
+    # last run reuse their face boxes, e.g. when only --size differs.
+    cached = {}
+    for image_path in image_paths:
+        row = cache.execute(
+            "SELECT mtime, boxes FROM faces WHERE path = ? AND detector = ?",
+            (os.path.abspath(image_path), detector_name),
+        ).fetchone()
+        if row is not None and row[0] == os.path.getmtime(image_path):
+            cached[image_path] = json.loads(row[1])
+    return cached
 
-def bulk_resize(input_path, size, output_folder, is_directory=True):
+def store_faces(cache, detected, detector_name):
+    with cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO faces VALUES (?, ?, ?, ?)",
+            [(os.path.abspath(image_path), detector_name, os.path.getmtime(image_path), json.dumps(faces))
+             for image_path, faces in detected.items()],
+        )
+
+def process_image(args):
+    image_path, size, output_folder, faces = args
+    image = read_image(image_path)
+    if faces is None:
+        faces = detect_faces(image)
+        detected = True
+    else:
+        detected = False
+    save_image(center_face(image, faces, size, image_path), image_path, output_folder)
+    return image_path, faces if detected else None
+
+def resize_sequential(image_paths, size, output_folder, cached, detected, written):
+    for image_path, image in prefetch_images(image_paths):
+        faces = cached.get(image_path)
+        if faces is None:
+            faces = detected[image_path] = detect_faces(image)
+        save_image(center_face(image, faces, size, image_path), image_path, output_folder)
+        written.append(image_path)
+
+def resize_parallel(image_paths, size, output_folder, cached, detected, written, workers):
+    # Several images per task keeps IPC overhead low, and unordered
+    # results stop one slow image from holding up the rest.
+    args_list = [(image_path, size, output_folder, cached.get(image_path)) for image_path in image_paths]
+    chunksize = max(1, len(image_paths) // (workers * 4))
+    with Pool(workers, initializer=_init_worker, initargs=(verbose,)) as pool:
+        for image_path, faces in pool.imap_unordered(process_image, args_list, chunksize=chunksize):
+            if faces is not None:
+                detected[image_path] = faces
+            written.append(image_path)
+
+def resize_batched(image_paths, size, output_folder, cached, detected, written, detect_batch):
+    images = prefetch_images(image_paths)
+    while batch := list(islice(images, GPU_BATCH_SIZE)):
+        batch_paths, batch_images = zip(*batch)
+        missing = [i for i, image_path in enumerate(batch_paths) if image_path not in cached]
+        if missing:
+            for i, faces in zip(missing, detect_batch([batch_images[i] for i in missing])):
+                cached[batch_paths[i]] = detected[batch_paths[i]] = faces
+        for image_path, image in zip(batch_paths, batch_images):
+            save_image(center_face(image, cached[image_path], size, image_path), image_path, output_folder)
+            written.append(image_path)
+
+def bulk_resize(input_path, size, output_folder, is_directory=True, workers=None, overwrite=False):
     if is_directory:
-        image_paths = [os.path.join(input_path, f) for f in os.listdir(input_path) if os.path.isfile(os.path.join(input_path, f))]
+        # scandir entries carry their file type, so no extra stat per file
+        with os.scandir(input_path) as entries:
+            image_paths = [entry.path for entry in entries
+                           if is_valid_image(entry.name) and entry.is_file()]
     else:
         image_paths = [input_path]
 
     if output_folder is None:
-            output_folder = Path(os.path.dirname(image_paths[0])) / "output"
+        output_folder = os.path.join(os.path.dirname(image_paths[0]), "output")
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    for image_path in image_paths:
-        resized_image = resize_and_center_face(image_path, size)
-        name, extension = os.path.splitext(os.path.basename(image_path))
-        output_name = name + ".out" + extension
-        output_path = os.path.join(output_folder, output_name)
-        resized_image.save(output_path)
-        print(f"Image saved to {output_path}")
-
-def parse_arguments():
+    cache = open_detection_cache(output_folder)
+
+    # Images already resized to this size by an earlier run are left alone,
+    # so an interrupted job can simply be started again.
+    if not overwrite:
+        finished = finished_images(cache, image_paths, output_folder, size)
+        if finished:
+            print(f"Skipping {len(finished)} images already in {output_folder}")
+            image_paths = [image_path for image_path in image_paths if image_path not in finished]
+        if not image_paths:
+            cache.close()
+            return
+
+    # An explicit --detector cnn wins over the FACECROP_DEVICE setting, in
+    # which case RetinaFace is never loaded.
+    use_gpu = os.environ.get("FACECROP_DEVICE") == "cuda"
+    if cnn_detector is not None:
+        if use_gpu:
+            print("Warning: --detector cnn overrides FACECROP_DEVICE=cuda, RetinaFace will not be used.")
+        detector_name, detect_batch = "cnn", detect_faces_cnn_batch
+    else:
+        if use_gpu and gpu_detector is None:
+            load_gpu_detector()
+        if gpu_detector is not None:
+            detector_name, detect_batch = "retinaface", detect_faces_batch
+        else:
+            detector_name, detect_batch = "hog", None
+    cached = cached_faces(cache, image_paths, detector_name)
+    detected = {}
+    written = []
+    try:
+        if detect_batch is not None:
+            resize_batched(image_paths, size, output_folder, cached, detected, written, detect_batch)
+        else:
+            workers = workers or min(default_workers(), len(image_paths))
+            if workers > 1:
+                resize_parallel(image_paths, size, output_folder, cached, detected, written, workers)
+            else:
+                resize_sequential(image_paths, size, output_folder, cached, detected, written)
+    finally:
+        # Keep whatever was detected and written, even if the run was interrupted
+        store_faces(cache, detected, detector_name)
+        store_outputs(cache, written, output_folder, size)
+        cache.close()
+
+    no_faces = sum(1 for image_path in image_paths if not detected.get(image_path, cached.get(image_path)))
+    print(f"Resized {len(image_paths)} images into {output_folder}")
+    if no_faces:
+        print(f"Warning: No faces found in {no_faces} images, used the image centre instead.")
+
+@lru_cache(maxsize=1)
+def _build_parser():
     parser = argparse.ArgumentParser(description="Bulk Image Resizer")
     input_group = parser.add_mutually_exclusive_group(required=True)
     input_group.add_argument('--dir', help='Path to directory containing images', type=str)
     input_group.add_argument('--file', help='Path to single image file', type=str)
     parser.add_argument('--output', help='Path to output directory', type=str)
     parser.add_argument('--size', help='Size of the output square image',default=224, type=int)
+    parser.add_argument('--detector', help='Face detector: dlib HOG on the CPU, or dlib CNN on the GPU', choices=['hog', 'cnn'], default='hog')
+    parser.add_argument('--cnn-model', help='Path to the dlib CNN face detector model', default='mmod_human_face_detector.dat', type=str)
+    parser.add_argument('--verbose', help='Print a message for every image', action='store_true')
+    parser.add_argument('--overwrite', help='Resize images even if their output already exists', action='store_true')
+    parser.add_argument('--workers', help='Number of worker processes (default: number of physical CPU cores)', type=int)
+
+    return parser
 
-    return parser.parse_args()
+def parse_arguments(argv=None):
+    # The parser is built once and reused for every call
+    return _build_parser().parse_args(argv)
 
 def main():
+    global verbose
     args = parse_arguments()
+    verbose = args.verbose
+
+    if args.detector == 'cnn':
+        load_cnn_detector(args.cnn_model)
 
     if args.output and not os.path.exists(args.output):
         os.makedirs(args.output)
@@ -75,7 +460,7 @@ def main():
         input_path = args.file
         is_directory = False
 
-    bulk_resize(input_path, args.size, args.output, is_directory)
+    bulk_resize(input_path, args.size, args.output, is_directory, args.workers, args.overwrite)
 
 if __name__ == '__main__':
     main()